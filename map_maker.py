@@ -1,8 +1,11 @@
+import functools
+from collections import OrderedDict
 import streamlit as st
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from io import BytesIO
+from matplotlib.collections import PatchCollection
+from io import BytesIO, StringIO
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 import json
@@ -10,6 +13,10 @@ import json
 # --- Config ---
 st.set_page_config(page_title="Wafer Mapping Tool", layout="wide")
 CANVAS_SIZE = 400  # pixels
+SQRT3_OVER_2 = 0.8660254037844386  # hexagonal row pitch per unit column spacing
+CIRCLE_SWEEP_THRESHOLD = 16  # circular zones above which points are matched to zones by sorted centers
+ZONE_BIN_THRESHOLD = 32  # zones/rects above which exclusion tests go through a spatial index
+ZONE_BIN_DIVISIONS = 16  # spatial index cells per side
 
 # --- Initialize session state for non-widget state ---
 if "canvas_reset_counter" not in st.session_state:
@@ -18,47 +25,242 @@ if "drawable_rects" not in st.session_state:
     st.session_state["drawable_rects"] = []
 
 # --- Utility Functions ---
+def session_memo(max_entries):
+    # Like st.cache_data, but the LRU lives in st.session_state: entries belong to
+    # one user and are freed with their session instead of shared server-wide.
+    # Results are returned as-is (not copied), so callers must not mutate them.
+    def decorator(fn):
+        state_key = f"_memo_{fn.__name__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args):
+            cache = st.session_state.setdefault(state_key, OrderedDict())
+            key = tuple(
+                (a.shape, a.tobytes()) if isinstance(a, np.ndarray) else a for a in args
+            )
+            if key in cache:
+                cache.move_to_end(key)
+            else:
+                cache[key] = fn(*args)
+                if len(cache) > max_entries:
+                    cache.popitem(last=False)
+            return cache[key]
+        return wrapper
+    return decorator
+
+def circles_mask(x, y, ex):
+    cx, cy, r = ex[:, 0], ex[:, 1], ex[:, 2]
+    # Cheap bounding-box prefilter: only points inside the zones' combined
+    # bounding box get the per-zone squared-distance test.
+    near = (
+        (x >= (cx - r).min()) & (x <= (cx + r).max())
+        & (y >= (cy - r).min()) & (y <= (cy + r).max())
+    )
+    mask = np.zeros(np.shape(x), dtype=bool)
+    xn, yn = x[near][:, None], y[near][:, None]
+    mask[near] = ((xn - cx)**2 + (yn - cy)**2 <= r**2).any(axis=-1)
+    return mask
+
+def rects_mask(x, y, rc):
+    rx, ry, rw, rh = rc[:, 0], rc[:, 1], rc[:, 2], rc[:, 3]
+    xx, yy = x[..., None], y[..., None]
+    return ((xx >= rx) & (xx <= rx + rw) & (yy >= ry) & (yy <= ry + rh)).any(axis=-1)
+
+def ragged_arange(starts, counts):
+    # Concatenation of arange(start, start + count) for every pair, in one shot
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+
+def sorted_circles_mask(x, y, ex):
+    # Sort the zones by center x; each point then only checks the zones whose
+    # center lies within the largest radius of it in x (found by searchsorted).
+    ex = ex[np.argsort(ex[:, 0])]
+    cx, cy, r = ex[:, 0], ex[:, 1], ex[:, 2]
+    xf, yf = np.ravel(x), np.ravel(y)
+    lo = np.searchsorted(cx, xf - r.max(), side='left')
+    hi = np.searchsorted(cx, xf + r.max(), side='right')
+    counts = hi - lo
+    pt = np.repeat(np.arange(len(xf)), counts)
+    zone = ragged_arange(lo, counts)
+    hit = (xf[pt] - cx[zone])**2 + (yf[pt] - cy[zone])**2 <= r[zone]**2
+    mask = np.zeros(len(xf), dtype=bool)
+    mask[pt[hit]] = True
+    return mask.reshape(np.shape(x))
+
+def binned_mask(x, y, shapes, bboxes, shape_mask):
+    # Uniform-grid index: bucket each shape into the cells its bounding box
+    # (xmin, ymin, xmax, ymax) overlaps, then test every point only against
+    # the shapes in its own cell.
+    mask = np.zeros(np.shape(x), dtype=bool)
+    if mask.size == 0:
+        return mask
+    xf, yf = np.ravel(x), np.ravel(y)
+    x0, y0 = xf.min(), yf.min()
+    cell = max(xf.max() - x0, yf.max() - y0, 1e-9) / ZONE_BIN_DIVISIONS
+    lo = np.floor((bboxes[:, :2] - (x0, y0)) / cell).astype(int).clip(0, ZONE_BIN_DIVISIONS)
+    hi = np.floor((bboxes[:, 2:] - (x0, y0)) / cell).astype(int).clip(0, ZONE_BIN_DIVISIONS)
+    bins = {}
+    for idx, ((i0, j0), (i1, j1)) in enumerate(zip(lo, hi)):
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                bins.setdefault((i, j), []).append(idx)
+
+    ci = np.floor((xf - x0) / cell).astype(int)
+    cj = np.floor((yf - y0) / cell).astype(int)
+    keys = ci * (ZONE_BIN_DIVISIONS + 1) + cj
+    order = np.argsort(keys, kind='stable')
+    cell_keys, starts = np.unique(keys[order], return_index=True)
+    flat = mask.reshape(-1)
+    for key, members in zip(cell_keys, np.split(order, starts[1:])):
+        idx = bins.get(divmod(int(key), ZONE_BIN_DIVISIONS + 1))
+        if idx:
+            flat[members] = shape_mask(xf[members], yf[members], shapes[idx])
+    return mask
+
 def is_inside_exclusion(x, y, zones):
-    return any((x-ex[0])**2 + (y-ex[1])**2 <= ex[2]**2 for ex in zones)
+    if len(zones) == 0:
+        return np.zeros(np.shape(x), dtype=bool)
+    ex = np.asarray(zones, dtype=float)
+    if len(ex) < CIRCLE_SWEEP_THRESHOLD:
+        return circles_mask(x, y, ex)
+    if len(ex) < ZONE_BIN_THRESHOLD:
+        return sorted_circles_mask(x, y, ex)
+    cx, cy, r = ex[:, 0], ex[:, 1], ex[:, 2]
+    bboxes = np.column_stack([cx - r, cy - r, cx + r, cy + r])
+    return binned_mask(x, y, ex, bboxes, circles_mask)
 
 def is_inside_rects(x, y, rects):
-    return any((x >= rx and x <= rx + rw and y >= ry and y <= ry + rh)
-               for (rx, ry, rw, rh) in rects)
+    if len(rects) == 0:
+        return np.zeros(np.shape(x), dtype=bool)
+    rc = np.asarray(rects, dtype=float)
+    if len(rc) < ZONE_BIN_THRESHOLD:
+        return rects_mask(x, y, rc)
+    bboxes = np.column_stack([rc[:, 0], rc[:, 1], rc[:, 0] + rc[:, 2], rc[:, 1] + rc[:, 3]])
+    return binned_mask(x, y, rc, bboxes, rects_mask)
 
+@session_memo(max_entries=16)
 def compute_points(
     wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
     exclusion_zones, drawable_rects
 ):
     wafer_radius = wafer_diameter / 2
-    points = []
+    x_range = np.arange(-wafer_radius + spacing_x/2, wafer_radius, spacing_x)
+    y_range = np.arange(-wafer_radius + spacing_y/2, wafer_radius, spacing_y)
     if grid_type == "Rectangular":
-        x_range = np.arange(-wafer_radius + spacing_x/2, wafer_radius, spacing_x)
-        y_range = np.arange(-wafer_radius + spacing_y/2, wafer_radius, spacing_y)
-        for x in x_range:
-            for y in y_range:
-                r2 = x**2 + y**2
-                if (
-                    (r2 <= wafer_radius**2)
-                    and (r2 <= (wafer_radius - edge_exclusion)**2)
-                    and not is_inside_exclusion(x, y, exclusion_zones)
-                    and not is_inside_rects(x, y, drawable_rects)
-                ):
-                    points.append((x, y))
-    else:  # hexagonal
-        x_range = np.arange(-wafer_radius + spacing_x/2, wafer_radius, spacing_x)
-        for i, x in enumerate(x_range):
-            offset = 0 if i % 2 == 0 else spacing_y / 2
-            y_range = np.arange(-wafer_radius + spacing_y/2 + offset, wafer_radius, spacing_y)
-            for y in y_range:
-                r2 = x**2 + y**2
-                if (
-                    (r2 <= wafer_radius**2)
-                    and (r2 <= (wafer_radius - edge_exclusion)**2)
-                    and not is_inside_exclusion(x, y, exclusion_zones)
-                    and not is_inside_rects(x, y, drawable_rects)
-                ):
-                    points.append((x, y))
-    return np.array(points), len(points)
+        offsets = np.zeros(len(x_range))
+    else:  # hexagonal: shift every other column by half a row
+        offsets = np.where(np.arange(len(x_range)) % 2, spacing_y / 2, 0.0)
+    r_eff2 = max(wafer_radius - edge_exclusion, 0.0)**2
+
+    # Only generate the rows of each column that can fall inside the usable disk,
+    # |y| <= sqrt(r_eff2 - x**2), padded by one row each way for rounding; the
+    # exact test below trims the padding.
+    y_lim = np.sqrt(np.maximum(r_eff2 - x_range**2, 0.0))
+    y0 = y_range[0] + offsets if len(y_range) else offsets
+    j_lo = np.maximum(np.ceil((-y_lim - y0) / spacing_y) - 1, 0).astype(int)
+    j_hi = np.minimum(np.floor((y_lim - y0) / spacing_y) + 1, len(y_range) - 1).astype(int)
+    counts = np.where(x_range**2 <= r_eff2, np.maximum(j_hi - j_lo + 1, 0), 0)
+    col = np.repeat(np.arange(len(x_range)), counts)
+    row = ragged_arange(j_lo, counts)
+    X, Y = x_range[col], y_range[row] + offsets[col]
+    on_wafer = (Y < wafer_radius) & (X*X + Y*Y <= r_eff2)
+    # Run the zone tests on the on-wafer candidates only
+    xs, ys = X[on_wafer], Y[on_wafer]
+    keep = ~is_inside_exclusion(xs, ys, exclusion_zones) & ~is_inside_rects(xs, ys, drawable_rects)
+    points = np.empty((np.count_nonzero(keep), 2))
+    np.compress(keep, xs, out=points[:, 0])
+    np.compress(keep, ys, out=points[:, 1])
+    points.setflags(write=False)
+    return points, len(points)
+
+@session_memo(max_entries=8)
+def render_wafer_bg(wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y, exclusion_zones):
+    # Rasterize directly onto a CANVAS_SIZE image spanning the wafer diameter, i.e. the
+    # same mm-per-pixel mapping used to read the drawn rectangles back off the canvas.
+    wafer_radius = wafer_diameter / 2
+    mm_per_px = wafer_diameter / CANVAS_SIZE
+    points_for_bg, _ = compute_points(
+        wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
+        exclusion_zones, ()
+    )
+    centers = (np.arange(CANVAS_SIZE) + 0.5) * mm_per_px - wafer_radius
+    xx = centers[None, :]
+    yy = -centers[:, None]  # image rows run top to bottom
+    r2 = xx*xx + yy*yy
+    img = np.full((CANVAS_SIZE, CANVAS_SIZE, 3), 255, dtype=np.uint8)
+    img[r2 <= wafer_radius**2] = (225, 225, 225)
+    for ex_x, ex_y, ex_r in exclusion_zones:
+        img[(xx - ex_x)**2 + (yy - ex_y)**2 <= ex_r**2] = (250, 190, 190)
+    if edge_exclusion > 0:
+        img[np.abs(np.sqrt(r2) - (wafer_radius - edge_exclusion)) <= mm_per_px] = (255, 165, 0)
+    if points_for_bg.size > 0:
+        px = ((points_for_bg[:, 0] + wafer_radius) / mm_per_px).astype(int)
+        py = ((wafer_radius - points_for_bg[:, 1]) / mm_per_px).astype(int)
+        for dx, dy in ((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)):
+            img[np.clip(py + dy, 0, CANVAS_SIZE - 1), np.clip(px + dx, 0, CANVAS_SIZE - 1)] = (0, 0, 255)
+    return Image.fromarray(img)
+
+@session_memo(max_entries=8)
+def build_viz_png(
+    wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
+    exclusion_zones, drawable_rects
+):
+    # Cache the encoded PNG rather than the Figure, so no matplotlib objects outlive the rerun.
+    wafer_radius = wafer_diameter / 2
+    points, _ = compute_points(
+        wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
+        exclusion_zones, drawable_rects
+    )
+    fig, ax = plt.subplots(figsize=(6, 6))
+    wafer_circle = plt.Circle((0, 0), wafer_radius, color='lightgray', fill=True, alpha=0.3, label='Wafer')
+    ax.add_patch(wafer_circle)
+    if edge_exclusion > 0:
+        edge_circle = plt.Circle((0, 0), wafer_radius - edge_exclusion, color='orange', fill=False, linestyle='--', linewidth=2, alpha=0.7, label='Edge exclusion')
+        ax.add_patch(edge_circle)
+    if exclusion_zones:
+        ax.add_collection(PatchCollection(
+            [plt.Circle((ex[0], ex[1]), ex[2]) for ex in exclusion_zones],
+            color='red', alpha=0.2, label='Exclusion zone'
+        ))
+    if drawable_rects:
+        ax.add_collection(PatchCollection(
+            [plt.Rectangle((rx, ry), rw, rh) for (rx, ry, rw, rh) in drawable_rects],
+            color='red', alpha=0.2, label='Rectangular zone'
+        ))
+    if points.size > 0:
+        ax.plot(points[:, 0], points[:, 1], 'o', color='blue', markersize=3, linestyle='', label='Measurement Points')
+    ax.set_aspect('equal')
+    ax.set_xlim(-wafer_radius-5, wafer_radius+5)
+    ax.set_ylim(-wafer_radius-5, wafer_radius+5)
+    ax.set_xlabel('X (mm)')
+    ax.set_ylabel('Y (mm)')
+    ax.set_title('Measurement Grid Map')
+    handles, labels = ax.get_legend_handles_labels()
+    unique = dict(zip(labels, handles))
+    ax.legend(unique.values(), unique.keys())
+    buf = BytesIO()
+    fig.savefig(buf, format="png", bbox_inches='tight', dpi=200)
+    plt.close(fig)
+    return buf.getvalue()
+
+@session_memo(max_entries=4)
+def coords_csv(points):
+    buf = StringIO()
+    np.savetxt(buf, points, fmt='%.6f', delimiter=',', header='X (mm),Y (mm)', comments='')
+    return buf.getvalue()
+
+def parse_rects(objects, wafer_diameter):
+    # Convert canvas rect objects (pixels, y down) to wafer (x, y, w, h) in mm, y up
+    wafer_radius = wafer_diameter / 2
+    rects = []
+    for obj in objects:
+        if obj["type"] == "rect":
+            x = obj["left"] * wafer_diameter / CANVAS_SIZE - wafer_radius
+            w = obj["width"] * wafer_diameter / CANVAS_SIZE
+            h = obj["height"] * wafer_diameter / CANVAS_SIZE
+            y_top_canvas = obj["top"] * wafer_diameter / CANVAS_SIZE
+            y_flipped = wafer_diameter - y_top_canvas - h - wafer_radius
+            rects.append((x, y_flipped, w, h))
+    return rects
 
 # --- Fetch all current values (always up-to-date via widget keys) ---
 wafer_diameter = st.session_state.get('wafer_diameter', 80.0)
@@ -69,7 +271,7 @@ grid_type = st.session_state.get('grid_type', "Rectangular")
 spacing_x = st.session_state.get('spacing_x', 2.0)
 spacing_y = (st.session_state.get('spacing_y', 2.0)
              if grid_type == "Rectangular"
-             else spacing_x * np.sqrt(3) / 2)
+             else spacing_x * SQRT3_OVER_2)
 measurement_time = st.session_state.get('measurement_time', 10.0)
 move_time = st.session_state.get('move_time', 1.0)
 exclusion_zones = st.session_state.get('exclusion_zones', [])
@@ -80,7 +282,7 @@ wafer_radius = wafer_diameter / 2
 # --- Always display point/time estimate at the top ---
 points, num_points = compute_points(
     wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
-    exclusion_zones, drawable_rects
+    tuple(map(tuple, exclusion_zones)), tuple(map(tuple, drawable_rects))
 )
 total_time = num_points * (measurement_time + move_time)
 st.info(
@@ -129,7 +331,7 @@ with tabs[0]:
                 "Grid spacing Y (mm)", value=spacing_y, min_value=0.01, key="spacing_y"
             )
         else:
-            spacing_y = spacing_x * np.sqrt(3) / 2
+            spacing_y = spacing_x * SQRT3_OVER_2
             st.markdown(f"**Grid spacing Y:** `{spacing_y:.3f}` mm (hexagonal)")
 
         st.subheader("Timing")
@@ -169,36 +371,14 @@ with tabs[1]:
     spacing_x = st.session_state['spacing_x']
     spacing_y = (st.session_state['spacing_y']
                  if grid_type == "Rectangular"
-                 else spacing_x * np.sqrt(3) / 2)
+                 else spacing_x * SQRT3_OVER_2)
     exclusion_zones = st.session_state['exclusion_zones']
-    wafer_radius = wafer_diameter / 2
 
-    # Always generate wafer image just-in-time!
-    points_for_bg, _ = compute_points(
+    # Always generate wafer image just-in-time (cached on the wafer/grid parameters)
+    bg_img = render_wafer_bg(
         wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
-        exclusion_zones, []
+        tuple(map(tuple, exclusion_zones))
     )
-    fig, ax = plt.subplots(figsize=(4, 4), dpi=100)
-    wafer_circle = plt.Circle((0, 0), wafer_radius, color='lightgray', fill=True, alpha=0.3)
-    ax.add_patch(wafer_circle)
-    if edge_exclusion > 0:
-        edge_circle = plt.Circle((0, 0), wafer_radius - edge_exclusion, color='orange', fill=False, linestyle='--', linewidth=2, alpha=0.7)
-        ax.add_patch(edge_circle)
-    for ex in exclusion_zones:
-        exc = plt.Circle((ex[0], ex[1]), ex[2], color='red', fill=True, alpha=0.2)
-        ax.add_patch(exc)
-    if points_for_bg.size > 0:
-        ax.scatter(points_for_bg[:, 0], points_for_bg[:, 1], s=10, color='blue')
-    ax.set_aspect('equal')
-    ax.set_xlim(-wafer_radius-5, wafer_radius+5)
-    ax.set_ylim(-wafer_radius-5, wafer_radius+5)
-    ax.axis('off')
-    fig.tight_layout(pad=0)
-    buf = BytesIO()
-    fig.savefig(buf, format="png", bbox_inches='tight', pad_inches=0, dpi=100)
-    buf.seek(0)
-    bg_img = Image.open(buf).convert("RGB")
-    plt.close(fig)
 
     c_reset, c_msg = st.columns([1, 8])
     with c_reset:
@@ -225,18 +405,13 @@ with tabs[1]:
         key=canvas_key,
     )
 
-    # Extract rectangles and save to session state
+    # Extract rectangles and save to session state, only when they changed so an
+    # unchanged canvas leaves the downstream state (and caches) untouched
     drawable_rects = []
     if canvas_result.json_data is not None:
-        for obj in canvas_result.json_data["objects"]:
-            if obj["type"] == "rect":
-                x = obj["left"] * wafer_diameter / CANVAS_SIZE - wafer_radius
-                w = obj["width"] * wafer_diameter / CANVAS_SIZE
-                h = obj["height"] * wafer_diameter / CANVAS_SIZE
-                y_top_canvas = obj["top"] * wafer_diameter / CANVAS_SIZE
-                y_flipped = wafer_diameter - y_top_canvas - h - wafer_radius
-                drawable_rects.append((x, y_flipped, w, h))
-    st.session_state['drawable_rects'] = drawable_rects
+        drawable_rects = parse_rects(canvas_result.json_data["objects"], wafer_diameter)
+    if drawable_rects != st.session_state.get('drawable_rects'):
+        st.session_state['drawable_rects'] = drawable_rects
 
 with tabs[2]:
     st.header("Visualization with All Exclusions")
@@ -246,14 +421,13 @@ with tabs[2]:
     spacing_x = st.session_state['spacing_x']
     spacing_y = (st.session_state['spacing_y']
                  if grid_type == "Rectangular"
-                 else spacing_x * np.sqrt(3) / 2)
+                 else spacing_x * SQRT3_OVER_2)
     exclusion_zones = st.session_state['exclusion_zones']
     drawable_rects = st.session_state['drawable_rects']
-    wafer_radius = wafer_diameter / 2
 
     points, num_points = compute_points(
         wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
-        exclusion_zones, drawable_rects
+        tuple(map(tuple, exclusion_zones)), tuple(map(tuple, drawable_rects))
     )
     total_time = num_points * (st.session_state['measurement_time'] + st.session_state['move_time'])
 
@@ -264,39 +438,18 @@ with tabs[2]:
         """
     )
 
-    fig, ax = plt.subplots(figsize=(6, 6))
-    wafer_circle = plt.Circle((0, 0), wafer_radius, color='lightgray', fill=True, alpha=0.3, label='Wafer')
-    ax.add_patch(wafer_circle)
-    if edge_exclusion > 0:
-        edge_circle = plt.Circle((0, 0), wafer_radius - edge_exclusion, color='orange', fill=False, linestyle='--', linewidth=2, alpha=0.7, label='Edge exclusion')
-        ax.add_patch(edge_circle)
-    for i, ex in enumerate(exclusion_zones):
-        exc = plt.Circle((ex[0], ex[1]), ex[2], color='red', fill=True, alpha=0.2, label='Exclusion zone' if i==0 else None)
-        ax.add_patch(exc)
-    for i, (rx, ry, rw, rh) in enumerate(drawable_rects):
-        rect_patch = plt.Rectangle(
-            (rx, ry), rw, rh, color='red', fill=True, alpha=0.2, label='Rectangular zone' if i==0 else None
-        )
-        ax.add_patch(rect_patch)
-    if points.size > 0:
-        ax.scatter(points[:, 0], points[:, 1], color='blue', s=10, label='Measurement Points')
-    ax.set_aspect('equal')
-    ax.set_xlim(-wafer_radius-5, wafer_radius+5)
-    ax.set_ylim(-wafer_radius-5, wafer_radius+5)
-    ax.set_xlabel('X (mm)')
-    ax.set_ylabel('Y (mm)')
-    ax.set_title('Measurement Grid Map')
-    handles, labels = ax.get_legend_handles_labels()
-    unique = dict(zip(labels, handles))
-    ax.legend(unique.values(), unique.keys())
-    st.pyplot(fig)
+    viz_png = build_viz_png(
+        wafer_diameter, edge_exclusion, grid_type, spacing_x, spacing_y,
+        tuple(map(tuple, exclusion_zones)), tuple(map(tuple, drawable_rects))
+    )
+    st.image(viz_png)
 
 with tabs[3]:
     st.header("Coordinates & Download")
     if num_points > 0:
         df_coords = pd.DataFrame(points, columns=['X (mm)', 'Y (mm)'])
         st.dataframe(df_coords)
-        csv = df_coords.to_csv(index=False)
+        csv = coords_csv(points)
         st.download_button("Download as CSV", csv, "wafer_coords.csv", "text/csv")
     else:
         st.warning("No points to show—check your parameters.")